@@ -1,109 +1,162 @@
 import streamlit as st
 import geopandas as gpd
 import rasterio
+from rasterio.io import MemoryFile
+from rasterio.windows import Window, from_bounds
 import numpy as np
-from shapely.geometry import LineString
+import shapely
 import ezdxf
 import pandas as pd
 import tempfile
 import zipfile
 import os
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from io import BytesIO, StringIO
 
 st.set_page_config(page_title="Haul Road Gradient Analysis", page_icon="🛣️", layout="wide")
 
+# Cap on the in-memory DTM band; larger rasters fall back to windowed reads
+MAX_BAND_BYTES = 1 * 1024 ** 3
+
+# Shared DXF attribute dicts — ezdxf copies them, so one dict per color
+# serves every entity instead of a fresh allocation per segment
+SEGMENT_ATTRS = {3: {'color': 3}, 1: {'color': 1}}
+TEXT_ATTRS = {'height': 4, 'color': 7}
+
 # --- Core Functions ---
-def get_elevation(point, dtm):
-    x, y = point.x, point.y
-    row, col = dtm.index(x, y)
-    elevation = dtm.read(1)[row, col]
-    return elevation
+def read_band_cached(dtm, segment_length):
+    # One full-band read per analysis instead of one read per sample point.
+    # When the sampling interval is much coarser than the pixel size, read
+    # decimated so GDAL serves the nearest overview instead of full-res data.
+    scale = max(1, int(segment_length / dtm.res[0] / 2))
+    out_shape = (max(1, dtm.height // scale), max(1, dtm.width // scale))
+    # float32 is plenty for elevation in meters and halves the bytes moved
+    band_bytes = out_shape[0] * out_shape[1] * np.dtype(np.float32).itemsize
+    if band_bytes > MAX_BAND_BYTES:
+        return None, None
+    band = dtm.read(1, out_shape=out_shape, out_dtype=np.float32)
+    transform = dtm.transform * rasterio.Affine.scale(
+        dtm.width / out_shape[1], dtm.height / out_shape[0])
+    return band, transform
+
+def read_line_window(line, dtm, margin):
+    # One windowed read covering the whole line instead of a full-band read per point
+    minx, miny, maxx, maxy = line.bounds
+    window = from_bounds(minx - margin, miny - margin, maxx + margin, maxy + margin, dtm.transform)
+    window = window.intersection(Window(0, 0, dtm.width, dtm.height))
+    arr = dtm.read(1, window=window, out_dtype=np.float32)
+    return arr, dtm.window_transform(window)
 
-def calculate_slope_fraction(line, dtm, segment_length):
+def sample_elevations(xs, ys, arr, inv_transform):
+    # Bilinear interpolation between pixel centers, as four vectorized
+    # gathers and a weighted sum — no per-point lookup
+    fx, fy = inv_transform * (xs, ys)
+    fx = np.asarray(fx) - 0.5
+    fy = np.asarray(fy) - 0.5
+    j0 = np.clip(np.floor(fx).astype(int), 0, arr.shape[1] - 2)
+    i0 = np.clip(np.floor(fy).astype(int), 0, arr.shape[0] - 2)
+    wx = np.clip(fx - j0, 0.0, 1.0)
+    wy = np.clip(fy - i0, 0.0, 1.0)
+    return ((1 - wy) * (1 - wx) * arr[i0, j0]
+            + (1 - wy) * wx * arr[i0, j0 + 1]
+            + wy * (1 - wx) * arr[i0 + 1, j0]
+            + wy * wx * arr[i0 + 1, j0 + 1])
+
+def calculate_slope_fraction(line, dtm, segment_length, band=None, band_inv=None):
     length = line.length
-    slopes = []
-    points = []
     distances = np.arange(0, length, segment_length)
-    if distances[-1] < length:
-        distances = np.append(distances, length)
-    elevations = []
-    for dist in distances:
-        point = line.interpolate(dist)
-        points.append(point)
-        elevation = get_elevation(point, dtm)
-        elevations.append(elevation)
-    for i in range(1, len(points)):
-        dx = points[i].distance(points[i-1])
-        dz = elevations[i] - elevations[i-1]
-        slope_ratio = dz/dx if dx != 0 else 0
-        slopes.append(slope_ratio)
-    return points, slopes
-
-def slope_to_fraction(slope_ratio):
-    if slope_ratio == 0:
-        return "Flat"
-    fraction = 1 / abs(slope_ratio)
-    return f"1/{fraction:.2f}"
-
-def slope_to_color(slope_ratio):
-    if -1/16 <= slope_ratio <= 1/16:
-        return 3  # Green
+    if distances.size == 0 or distances[-1] != length:
+        distances = np.concatenate((distances, [length]))
+    # Vectorized shapely 2.x ufuncs: all interpolations and coordinate
+    # extractions happen in one C-level call instead of per-point loops
+    coords = shapely.get_coordinates(shapely.line_interpolate_point(line, distances))
+    xs, ys = coords[:, 0], coords[:, 1]
+    if band is not None:
+        elevations = sample_elevations(xs, ys, band, band_inv)
     else:
-        return 1  # Red
+        arr, window_transform = read_line_window(line, dtm, segment_length)
+        elevations = sample_elevations(xs, ys, arr, ~window_transform)
+    dx = np.hypot(np.diff(xs), np.diff(ys))
+    dz = np.diff(elevations)
+    slopes = np.where(dx != 0, dz / dx, 0.0)
+    return coords, slopes
+
+def slope_fraction_labels(slopes):
+    # One masked division for the whole line; formatted once and reused
+    # by both the detailed table and the DXF text labels
+    with np.errstate(divide='ignore'):
+        fractions = np.where(slopes == 0, np.nan, 1.0 / np.abs(slopes))
+    return ["Flat" if np.isnan(f) else f"1/{f:.2f}" for f in fractions]
+
+@st.cache_data(show_spinner=False)
+def load_shapefile(zip_bytes):
+    # Cached on the ZIP bytes, so re-running the analysis with the same
+    # upload skips the extract + parse entirely
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with zipfile.ZipFile(BytesIO(zip_bytes), 'r') as zip_ref:
+            zip_ref.extractall(tmpdir)
+        shp_files = [f for f in os.listdir(tmpdir) if f.endswith(".shp")]
+        if not shp_files:
+            return None
+        return gpd.read_file(os.path.join(tmpdir, shp_files[0]))
 
-def process_shapefile(shapefile_path):
-    gdf = gpd.read_file(shapefile_path)
-    return gdf, [geom for geom in gdf.geometry if isinstance(geom, LineString)]
+def process_shapefile(gdf):
+    # C-level geom_type mask instead of an isinstance loop; the result
+    # stays a numpy object array ready for shapely 2.x ufuncs
+    return gdf.geometry.values[gdf.geom_type.eq('LineString').to_numpy()]
 
-def process_haul_road(shapefile_path, dtm_path, segment_length):
-    gdf, lines = process_shapefile(shapefile_path)
+def open_dtm(stack, dtm_src):
+    # An uploaded DTM arrives as bytes and opens through a MemoryFile with
+    # no disk round-trip; a string is treated as a local path
+    if isinstance(dtm_src, bytes):
+        memfile = stack.enter_context(MemoryFile(dtm_src))
+        return stack.enter_context(memfile.open())
+    return stack.enter_context(rasterio.open(dtm_src))
+
+def analyze_line(line, dtm, segment_length, band, band_inv):
+    # Pure numpy/GEOS per-line pass; safe to run concurrently when the
+    # band is cached in memory (numpy and GEOS release the GIL)
+    coords, slopes = calculate_slope_fraction(line, dtm, segment_length, band, band_inv)
+    seg_len = np.hypot(*np.diff(coords, axis=0).T)
+    colors = np.where(np.abs(slopes) <= 1/16, 3, 1)
+    mids = 0.5 * (coords[:-1] + coords[1:])
+    labels = slope_fraction_labels(slopes)
+    return coords, slopes, seg_len, colors, mids, labels
+
+def analyze(gdf, dtm_src, segment_length):
+    lines = process_shapefile(gdf)
     total_length = green_length = red_length = 0
-    detailed_results = []
-
-    with rasterio.open(dtm_path) as dtm:
-        doc = ezdxf.new(dxfversion='R2010')
-        msp = doc.modelspace()
-
-        for idx, line in enumerate(lines):
-            points, slopes = calculate_slope_fraction(line, dtm, segment_length)
-            for i in range(len(points) - 1):
-                segment = LineString([points[i], points[i+1]])
-                slope_ratio = slopes[i]
-                color = slope_to_color(slope_ratio)
-                segment_length_meters = segment.length
-                total_length += segment_length_meters
-                if color == 3:
-                    green_length += segment_length_meters
-                    status = "Acceptable"
-                else:
-                    red_length += segment_length_meters
-                    status = "Steep"
-
-                detailed_results.append({
-                    'Segment': f"{idx+1}-{i+1}",
-                    'Length (m)': round(segment_length_meters, 2),
-                    'Slope Ratio': round(slope_ratio, 4),
-                    'Slope Fraction': slope_to_fraction(slope_ratio),
-                    'Status': status
-                })
-
-                # DXF elements
-                msp.add_lwpolyline(list(segment.coords), dxfattribs={'color': color})
-                buffer_polygon = segment.buffer(5, cap_style='flat')
-                hatch = msp.add_hatch(color=color)
-                hatch.paths.add_polyline_path(buffer_polygon.exterior.coords)
-                midpoint = segment.interpolate(0.5, normalized=True)
-                msp.add_text(f"{slope_to_fraction(slope_ratio)}",
-                             dxfattribs={'height': 4, 'color': 7}).set_dxf_attrib('insert', (midpoint.x, midpoint.y))
-
-        # Save DXF to buffer
-        dxf_buffer = BytesIO()
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.dxf') as tmp:
-            doc.saveas(tmp.name)
-            with open(tmp.name, 'rb') as f:
-                dxf_buffer.write(f.read())
-            os.unlink(tmp.name)
-        dxf_buffer.seek(0)
+    # Columnar accumulators; the detailed DataFrame is built once at the end
+    detailed_columns = {'Segment': [], 'Length (m)': [], 'Slope Ratio': [],
+                        'Slope Fraction': [], 'Status': []}
+
+    with ExitStack() as stack:
+        dtm = open_dtm(stack, dtm_src)
+        band, band_transform = read_band_cached(dtm, segment_length)
+        # Invert the affine once; every sample lookup reuses it
+        band_inv = ~band_transform if band is not None else None
+        if band is not None and len(lines) > 1:
+            with ThreadPoolExecutor() as pool:
+                line_results = list(pool.map(
+                    lambda line: analyze_line(line, dtm, segment_length, band, band_inv),
+                    lines))
+        else:
+            # Windowed fallback reads through the dataset handle, which is
+            # not thread-safe — keep it serial
+            line_results = [analyze_line(line, dtm, segment_length, band, band_inv)
+                            for line in lines]
+
+    for idx, (coords, slopes, seg_len, colors, mids, labels) in enumerate(line_results):
+        total_length += seg_len.sum()
+        green_length += seg_len[colors == 3].sum()
+        red_length += seg_len[colors == 1].sum()
+
+        detailed_columns['Segment'].extend(f"{idx+1}-{i+1}" for i in range(len(slopes)))
+        detailed_columns['Length (m)'].append(np.round(seg_len, 2))
+        detailed_columns['Slope Ratio'].append(np.round(slopes, 4))
+        detailed_columns['Slope Fraction'].extend(labels)
+        detailed_columns['Status'].append(np.where(colors == 3, "Acceptable", "Steep"))
 
     summary_data = {
         'Category': ['Total Length', 'Green (Acceptable)', 'Red (Steep)'],
@@ -114,7 +167,82 @@ def process_haul_road(shapefile_path, dtm_path, segment_length):
             round((red_length/total_length)*100, 2) if total_length > 0 else 0
         ]
     }
-    return dxf_buffer, pd.DataFrame(summary_data), pd.DataFrame(detailed_results)
+    detailed_df = pd.DataFrame({
+        'Segment': detailed_columns['Segment'],
+        'Length (m)': np.concatenate(detailed_columns['Length (m)']) if detailed_columns['Length (m)'] else [],
+        'Slope Ratio': np.concatenate(detailed_columns['Slope Ratio']) if detailed_columns['Slope Ratio'] else [],
+        'Slope Fraction': detailed_columns['Slope Fraction'],
+        'Status': np.concatenate(detailed_columns['Status']) if detailed_columns['Status'] else []
+    })
+    return pd.DataFrame(summary_data), detailed_df, line_results
+
+def build_dxf(line_results):
+    # DXF construction is the slowest phase — only run when the user
+    # actually asks for the drawing
+    doc = ezdxf.new(dxfversion='R2010')
+    msp = doc.modelspace()
+
+    # A HATCH holds any number of boundary paths, so one hatch per color
+    # replaces one hatch entity per segment. Created on first use, so a
+    # single-color or empty drawing never carries a boundary-less HATCH
+    hatches = {}
+
+    for coords, slopes, seg_len, colors, mids, labels in line_results:
+        if len(slopes) == 0:
+            continue
+        # Run-length encode consecutive same-color segments: one polyline,
+        # one hatch path and one label per run instead of per segment
+        breaks = np.flatnonzero(np.diff(colors)) + 1
+        starts = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks, [len(colors)]))
+        run_len = np.add.reduceat(seg_len, starts)
+        run_rise = np.add.reduceat(slopes * seg_len, starts)
+        run_slopes = np.where(run_len != 0, run_rise / np.where(run_len != 0, run_len, 1), 0.0)
+        run_labels = slope_fraction_labels(run_slopes)
+        run_lines = np.array([shapely.LineString(coords[s:e + 1])
+                              for s, e in zip(starts, ends)], dtype=object)
+        run_buffers = shapely.buffer(run_lines, 5, cap_style='flat')
+
+        for r, (s, e) in enumerate(zip(starts, ends)):
+            color = int(colors[s])
+            msp.add_lwpolyline([tuple(c) for c in coords[s:e + 1]], dxfattribs=SEGMENT_ATTRS[color])
+            hatch = hatches.get(color)
+            if hatch is None:
+                hatch = hatches[color] = msp.add_hatch(color=color)
+            hatch.paths.add_polyline_path(run_buffers[r].exterior.coords)
+            msp.add_text(run_labels[r],
+                         dxfattribs=dict(TEXT_ATTRS, insert=tuple(mids[(s + e - 1) // 2])))
+
+    # Save DXF to buffer — ezdxf writes text streams directly,
+    # no temp file round-trip needed
+    text_buffer = StringIO()
+    doc.write(text_buffer)
+    dxf_buffer = BytesIO(text_buffer.getvalue().encode('utf-8'))
+    dxf_buffer.seek(0)
+    return dxf_buffer
+
+def to_excel_bytes(df):
+    # xlsxwriter is faster than the default openpyxl engine. Its
+    # constant-memory mode is NOT usable here: df.to_excel writes cell
+    # data column-by-column, and constant memory flushes each row as soon
+    # as a later one is touched, dropping most of the table
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False)
+    buf.seek(0)
+    return buf
+
+@st.cache_data(show_spinner=False)
+def run_analysis(zip_bytes, dtm_src, segment_length):
+    gdf = load_shapefile(zip_bytes)
+    if gdf is None:
+        return None
+    return analyze(gdf, dtm_src, segment_length)
+
+@st.cache_data(show_spinner=False)
+def run_build_dxf(zip_bytes, dtm_src, segment_length):
+    _, _, line_results = run_analysis(zip_bytes, dtm_src, segment_length)
+    return build_dxf(line_results)
 
 # --- Streamlit UI ---
 st.title("🛣️ Haul Road Gradient Analysis")
@@ -122,46 +250,43 @@ st.markdown("---")
 
 # Upload shapefile ZIP
 shapefile_zip = st.file_uploader("Upload Shapefile ZIP (.zip)", type=["zip"])
-dtm_path = st.text_input("Enter Local DTM File Path (.tif)", value=r"D:\Haul Road\DTM\your_large_dtm.tif")
+dtm_file = st.file_uploader("Upload DTM GeoTIFF (.tif)", type=["tif", "tiff"])
+dtm_path = st.text_input("...or enter a local DTM file path for very large rasters (.tif)", value="")
 segment_length = st.number_input("Segment Length (meters)", min_value=1, value=25)
 
 if st.button("🚀 Run Analysis"):
-    if not shapefile_zip or not dtm_path:
-        st.error("Please upload shapefile ZIP and enter DTM path!")
+    if not shapefile_zip or not (dtm_file or dtm_path):
+        st.error("Please upload shapefile ZIP and provide a DTM!")
     else:
-        try:
-            with st.spinner("Processing..."):
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    # Extract ZIP
-                    zip_path = os.path.join(tmpdir, "shapefile.zip")
-                    with open(zip_path, "wb") as f:
-                        f.write(shapefile_zip.read())
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        zip_ref.extractall(tmpdir)
-
-                    # Find .shp file
-                    shp_files = [f for f in os.listdir(tmpdir) if f.endswith(".shp")]
-                    if not shp_files:
-                        st.error("No .shp file found in ZIP!")
-                    else:
-                        shp_path = os.path.join(tmpdir, shp_files[0])
-                        dxf_buffer, summary_df, detailed_df = process_haul_road(shp_path, dtm_path, segment_length)
-
-                        st.success("✅ Analysis completed!")
-                        st.subheader("📊 Summary")
-                        st.dataframe(summary_df)
-                        st.subheader("📋 Detailed Analysis")
-                        st.dataframe(detailed_df)
-
-                        st.download_button("📥 Download DXF", data=dxf_buffer, file_name="haul_road_gradient.dxf", mime="application/dxf")
-                        excel_summary = BytesIO()
-                        summary_df.to_excel(excel_summary, index=False)
-                        excel_summary.seek(0)
-                        st.download_button("📥 Download Summary (Excel)", data=excel_summary, file_name="summary.xlsx")
-                        excel_detailed = BytesIO()
-                        detailed_df.to_excel(excel_detailed, index=False)
-                        excel_detailed.seek(0)
-                        st.download_button("📥 Download Detailed (Excel)", data=excel_detailed, file_name="detailed.xlsx")
-        except Exception as e:
-            st.error(f"❌ Error: {str(e)}")
-            st.exception(e)
+        st.session_state['analysis_requested'] = True
+
+if st.session_state.get('analysis_requested') and shapefile_zip and (dtm_file or dtm_path):
+    try:
+        with st.spinner("Processing..."):
+            # getvalue() never moves the file cursor, so reruns and the
+            # lazy DXF stage all see the same bytes
+            zip_bytes = shapefile_zip.getvalue()
+            dtm_src = dtm_file.getvalue() if dtm_file else dtm_path
+            result = run_analysis(zip_bytes, dtm_src, segment_length)
+        if result is None:
+            st.error("No .shp file found in ZIP!")
+        else:
+            summary_df, detailed_df, _ = result
+
+            st.success("✅ Analysis completed!")
+            st.subheader("📊 Summary")
+            st.dataframe(summary_df)
+            st.subheader("📋 Detailed Analysis")
+            st.dataframe(detailed_df)
+
+            st.download_button("📥 Download Summary (Excel)", data=to_excel_bytes(summary_df), file_name="summary.xlsx")
+            st.download_button("📥 Download Detailed (Excel)", data=to_excel_bytes(detailed_df), file_name="detailed.xlsx")
+
+            # The drawing is expensive to build — generate it on demand only
+            if st.button("✏️ Generate DXF"):
+                with st.spinner("Building DXF..."):
+                    dxf_buffer = run_build_dxf(zip_bytes, dtm_src, segment_length)
+                st.download_button("📥 Download DXF", data=dxf_buffer, file_name="haul_road_gradient.dxf", mime="application/dxf")
+    except Exception as e:
+        st.error(f"❌ Error: {str(e)}")
+        st.exception(e)